@@ -0,0 +1,81 @@
+"""
+CPU resize+LUT backend for machines without an NVIDIA GPU.
+
+Decodes with PyAV, applies the 3D LUT with vectorized NumPy trilinear
+interpolation (several times faster than ffmpeg's scalar lut3d filter),
+and encodes with libx265. Audio packets are remuxed as-is.
+
+Requires the optional av and numpy packages.
+"""
+
+from dji_common import load_cube_lut, parse_bitrate
+
+
+def _apply_lut(np, rgb, lut):
+    """Trilinear 3D-LUT lookup on an (h, w, 3) float array in [0, 1]."""
+    size = lut.shape[0]
+    scaled = rgb * (size - 1)
+    idx = np.clip(np.floor(scaled).astype(np.int32), 0, size - 2)
+    frac = scaled - idx
+    r0, g0, b0 = idx[..., 0], idx[..., 1], idx[..., 2]
+    fr, fg, fb = frac[..., 0:1], frac[..., 1:2], frac[..., 2:3]
+
+    def corner(db, dg, dr):
+        # lut is indexed [b, g, r]
+        return lut[b0 + db, g0 + dg, r0 + dr]
+
+    c00 = corner(0, 0, 0) * (1 - fr) + corner(0, 0, 1) * fr
+    c10 = corner(0, 1, 0) * (1 - fr) + corner(0, 1, 1) * fr
+    c01 = corner(1, 0, 0) * (1 - fr) + corner(1, 0, 1) * fr
+    c11 = corner(1, 1, 0) * (1 - fr) + corner(1, 1, 1) * fr
+    c0 = c00 * (1 - fg) + c10 * fg
+    c1 = c01 * (1 - fg) + c11 * fg
+    return c0 * (1 - fb) + c1 * fb
+
+
+def transcode(input_file, output_file, lut_file, bitrate, target_width=1920):
+    """Decode, resize, grade, and re-encode on the CPU."""
+    import av
+    import numpy as np
+
+    lut = load_cube_lut(lut_file)
+    with av.open(input_file) as in_container, av.open(output_file, "w") as out_container:
+        in_video = in_container.streams.video[0]
+        in_video.thread_type = "AUTO"
+        out_height = int(round(in_video.codec_context.height
+                               * target_width / in_video.codec_context.width / 2)) * 2
+
+        out_video = out_container.add_stream("libx265", rate=in_video.average_rate)
+        out_video.width = target_width
+        out_video.height = out_height
+        out_video.pix_fmt = "yuv420p"
+        out_video.bit_rate = parse_bitrate(bitrate)
+        out_video.options = {"preset": "medium"}
+
+        in_audio = in_container.streams.audio[0] if in_container.streams.audio else None
+        out_audio = out_container.add_stream(template=in_audio) if in_audio else None
+
+        streams = [s for s in (in_video, in_audio) if s is not None]
+        for packet in in_container.demux(streams):
+            if packet.stream is in_video:
+                # flush packets (dts None) must be decoded too, or the frames
+                # buffered by threaded decoding are dropped from the tail
+                for frame in packet.decode():
+                    frame = frame.reformat(width=target_width, height=out_height,
+                                           format="rgb24")
+                    rgb = frame.to_ndarray().astype(np.float32) / 255.0
+                    rgb = _apply_lut(np, rgb, lut)
+                    graded = av.VideoFrame.from_ndarray(
+                        (np.clip(rgb, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8),
+                        format="rgb24")
+                    graded.pts = frame.pts
+                    graded.time_base = frame.time_base
+                    for out_packet in out_video.encode(graded):
+                        out_container.mux(out_packet)
+            else:
+                if packet.dts is None:
+                    continue
+                packet.stream = out_audio
+                out_container.mux(packet)
+        for out_packet in out_video.encode():
+            out_container.mux(out_packet)
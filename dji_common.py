@@ -0,0 +1,137 @@
+"""
+Helpers shared between the DJI preview script and the transcode backends.
+
+Keeping the subprocess runner, color-mode detection, and LUT loading in
+one place means optimizations land once instead of drifting apart across
+the scripts that need them.
+"""
+
+import functools
+import os
+import re
+import subprocess
+
+COLOR_MODE_BY_CODE = {
+    9: "hlog",
+    19: "dlog_m",
+    2: "d_log",
+}
+
+_COLOR_MD_RE = re.compile(r"\[color_md : (.*?)\]")
+
+
+def run_command(command, capture_stdout=False):
+    """Run ffmpeg/ffprobe without inheriting stdin and with stderr captured.
+
+    An inherited console stdin makes ffmpeg poll for keypresses, and parallel
+    workers writing stderr to the same console interleave into garbage; on
+    failure the stderr tail is printed so -loglevel error messages survive.
+    """
+    result = subprocess.run(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE if capture_stdout else None,
+        stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        stderr_tail = result.stderr.decode(errors='replace')[-2000:]
+        print(f"Command failed with code {result.returncode}: {' '.join(command)}\n{stderr_tail}")
+        raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+    return result.stdout
+
+
+def parse_bitrate(bitrate):
+    if isinstance(bitrate, int):
+        return bitrate
+    value = bitrate.strip().upper()
+    if value.endswith("M"):
+        return int(float(value[:-1]) * 1_000_000)
+    if value.endswith("K"):
+        return int(float(value[:-1]) * 1_000)
+    return int(value)
+
+
+def load_cube_lut(lut_file):
+    """Load a .cube file into a float32 ndarray indexed [b, g, r, channel]."""
+    import numpy as np
+
+    size = None
+    values = []
+    with open(lut_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            if parts[0] == "LUT_3D_SIZE":
+                size = int(parts[1])
+            elif parts[0][0] in "+-.0123456789":
+                values.append([float(p) for p in parts[:3]])
+    if size is None or len(values) != size ** 3:
+        raise ValueError(f"'{lut_file}' is not a valid 3D cube LUT")
+    # .cube data is red-fastest, so reshape yields [b][g][r]
+    return np.asarray(values, dtype=np.float32).reshape(size, size, size, 3)
+
+
+@functools.lru_cache(maxsize=None)
+def _color_mode_for_stem(directory, stem):
+    srt_file = os.path.join(directory, f"{stem}.srt")
+    if not os.path.exists(srt_file):
+        return None
+    with open(srt_file, "r") as f:
+        # the tag appears in the first subtitle entry, no need to read it all
+        srt_content = f.read(4096)
+        match = _COLOR_MD_RE.search(srt_content)
+        return match.group(1) if match else None
+
+
+def color_mode_for_file(file):
+    """Look up the color mode from the SRT sitting next to the video, if any."""
+    stem = os.path.splitext(os.path.basename(file))[0]
+    return _color_mode_for_stem(os.path.dirname(file), stem)
+
+
+def _decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _find_protobuf_field(data, start, end, field_number):
+    """Return (varint value, submessage span) for the first match in [start, end)."""
+    pos = start
+    while pos < end:
+        key, pos = _decode_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _decode_varint(data, pos)
+            if field == field_number:
+                return value, None
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _decode_varint(data, pos)
+            if field == field_number:
+                return None, (pos, pos + length)
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+    return None, None
+
+
+def get_color_mode_code(binary_data):
+    """Walk fields 2 -> 2 -> 3 -> 1 of the DJI data-stream protobuf."""
+    span = (0, len(binary_data))
+    for field in (2, 2, 3):
+        _, span = _find_protobuf_field(binary_data, span[0], span[1], field)
+        if span is None:
+            return None
+    value, _ = _find_protobuf_field(binary_data, span[0], span[1], 1)
+    return value
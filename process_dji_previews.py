@@ -3,128 +3,188 @@ Generate resized previews from DJI drone videos.
 """
 
 import argparse
+import concurrent.futures
 import json
 import os
-import re
-import shutil
 import subprocess
 import sys
 from pathlib import Path
 from typing import List, Tuple
 
-import blackboxprotobuf
 from colorama import Style, Fore
 
-temp_dir = "temp"
-temp_encode_dir = "temp_encode"
+from dji_common import COLOR_MODE_BY_CODE, color_mode_for_file, get_color_mode_code, run_command
+
 convertable_color_modes = ["d_log"]
 input_format = "mp4"
-encoding_preset = "p7"
-intermediate_video_bitrate = "30M"
+backend = "ffmpeg"
+encode_profile = "quality"
 final_video_bitrate = "10M"
 max_video_bitrate = "30M"
 video_buffer_size = "5M"
-temp_video_dir = None
 video_preview_file_suffix = "_preview"
 output_extension = ".mp4"
 regenerate_previews = False
+keep_intermediate = False
+
+# "fast" trades some quality for 2-3x encode throughput on recent GPUs;
+# extra_hw_frames/bf keep NVDEC from running out of output surfaces and stalling
+NVENC_PROFILES = {
+    "fast": {"preset": "p1", "tune": "ll", "split_encode_mode": 2, "extra_hw_frames": 8, "bf": 0},
+    "balanced": {"preset": "p4", "tune": "hq", "split_encode_mode": 0, "extra_hw_frames": 8, "bf": 0},
+    "quality": {"preset": "p7", "tune": "hq", "split_encode_mode": 0, "extra_hw_frames": 8, "bf": 2},
+}
+
+_video_metadata_cache = {}
+
+
+def check_backend_dependencies(name):
+    """Fail fast if the selected backend's optional packages are missing.
+
+    The backends import their dependencies lazily, and import errors inside
+    the worker would be swallowed with the rest of the per-file failures.
+    """
+    try:
+        if name == "pynvc":
+            import cupy
+            import PyNvVideoCodec
+        elif name == "cpu":
+            import av
+            import numpy
+    except ImportError as e:
+        required = "PyNvVideoCodec and cupy" if name == "pynvc" else "av and numpy"
+        print(f"The {name} backend requires the {required} packages to be installed: {e}")
+        sys.exit(1)
+
+
+def count_gpus():
+    try:
+        result = subprocess.run(['nvidia-smi', '-L'], check=True, capture_output=True, text=True,
+                                stdin=subprocess.DEVNULL)
+        return max(1, len([line for line in result.stdout.splitlines() if line.strip()]))
+    except (OSError, subprocess.CalledProcessError):
+        return 1
+
+
+def build_nvenc_args(bitrate, gpu=0):
+    profile = NVENC_PROFILES[encode_profile]
+    args = [
+        '-c:v', 'hevc_nvenc',
+        '-gpu', str(gpu),
+        '-preset', profile["preset"],
+        '-tune', profile["tune"],
+    ]
+    if profile["split_encode_mode"]:
+        # only recent ffmpeg (7.x) knows this option; skip it when it would
+        # be a no-op so the default profiles keep working on older builds
+        args += ['-split_encode_mode', str(profile["split_encode_mode"])]
+    args += ['-bf', str(profile["bf"])]
+    if profile["bf"]:
+        args += ['-b_ref_mode', 'middle']
+    args += [
+        '-b:v', bitrate,
+        '-maxrate', max_video_bitrate,
+        '-bufsize', video_buffer_size,
+    ]
+    return args
+
+
+def escape_filter_value(value):
+    # the filter argument string is unescaped twice - by the graph parser and
+    # then by the ':'-separated option parser - so characters special at the
+    # option level ('\', ':', "'") need a double escape (e.g. a Windows drive
+    # colon becomes \\:), while ',;[]' only exist at the graph level
+    value = value.replace("\\", "\\\\\\\\")
+    for char in ":'":
+        value = value.replace(char, "\\\\" + char)
+    for char in ",;[]":
+        value = value.replace(char, "\\" + char)
+    return value
 
 
-def apply_lut(input_file, output_file, lut_file):
+def resize_and_apply_lut(input_file, output_file, lut_file, gpu=0, intermediate_file=None):
     if not os.path.exists(lut_file):
         raise FileNotFoundError(f"LUT file '{lut_file}' not found.")
 
-    print(f"\t\tApplying LUT...")
+    print(f"\t\tResizing and applying LUT...")
+    lut_filter = f"lut3d={escape_filter_value(lut_file)}"
     ffmpeg_command = [
         'ffmpeg',
         '-y',
-        '-vsync', '0',
-        '-stats', '-loglevel', 'error',
+        '-nostdin',
+        '-loglevel', 'error',
+        '-hwaccel', 'cuda',
+        '-hwaccel_device', str(gpu),
+        '-hwaccel_output_format', 'cuda',
+        '-extra_hw_frames', str(NVENC_PROFILES[encode_profile]["extra_hw_frames"]),
         '-i', input_file,
-        '-vf',
-        f"lut3d={lut_file}",
+    ]
+    if intermediate_file is None:
+        ffmpeg_command += [
+            '-vf',
+            f"scale_cuda=1920:-1,hwdownload,format=nv12,{lut_filter},format=yuv420p",
+        ]
+    else:
+        # one decode, two encodes: the resized stream and the LUT'd stream
+        ffmpeg_command += [
+            '-filter_complex',
+            f"[0:v]scale_cuda=1920:-1,split=2[s1][s2];"
+            f"[s2]hwdownload,format=nv12,{lut_filter},format=yuv420p[luted]",
+            '-map', '[s1]',
+            *build_nvenc_args(final_video_bitrate, gpu),
+            '-fps_mode', 'passthrough',
+            '-an', '-sn', '-dn',
+            intermediate_file,
+            '-map', '[luted]',
+            '-map', '0:a?',
+        ]
+    ffmpeg_command += [
         '-profile:v', 'main',
-        '-pix_fmt', 'yuv420p',
-        '-c:v', 'hevc_nvenc',
-        '-preset', encoding_preset,
+        *build_nvenc_args(final_video_bitrate, gpu),
+        '-fps_mode', 'passthrough',
         '-c:a', 'copy',
-        '-b:v', final_video_bitrate,
-        '-maxrate', max_video_bitrate,
-        '-bufsize', video_buffer_size,
         output_file
     ]
-    subprocess.run(ffmpeg_command, check=True)
-
-
-def copy_file_to_temp_dir(file):
-    if not os.path.exists(temp_dir):
-        os.mkdir(temp_dir)
-
-    dest_file_path = os.path.join(temp_dir,
-                                  os.path.basename(file))
-    try:
-        shutil.copy2(file, dest_file_path)
-    except (shutil.Error, OSError) as e:
-        print(f"Error copying file: {e}")
-        sys.exit(1)
-    return Path(dest_file_path).as_posix()
-
-
-def get_bin_filename(file, suffix):
-    return f"{get_filename_without_extension(file)}_{suffix}.bin"
-
-
-def get_color_mode_from_subs(file):
-    srt_file = os.path.join(os.path.dirname(file), f"{get_filename_without_extension(file)}.srt")
-    if not os.path.exists(srt_file):
-        return None
-    with open(srt_file, "r") as f:
-        srt_content = f.read()
-        pattern = r"\[color_md : (.*?)\]"
-        match = re.search(pattern, srt_content)
-        return match.group(1) if match else None
+    run_command(ffmpeg_command)
 
 
 def get_color_mode_from_data_stream(file):
-    filename = get_bin_filename(file, "0")
-    intermediate_file = os.path.join(temp_video_dir, filename)
     ffmpeg_command = [
         'ffmpeg',
+        '-nostdin',
         '-v', 'quiet',
         '-i', file,
         '-map', '0:d:0',
         '-f', 'data',
-        intermediate_file
+        '-'
     ]
-    subprocess.run(ffmpeg_command, check=True)
-    binary_data = load_binary_file(intermediate_file)
-    message, typedef = blackboxprotobuf.protobuf_to_json(binary_data)
-    message = json.loads(message)
+    binary_data = run_command(ffmpeg_command, capture_stdout=True)
     try:
-        color_mode_code = message['2']['2']['3']['1']
-        print(f"Color mode code: {color_mode_code}; file: {file}")
-        if color_mode_code == 9:
-            return "hlog"
-        if color_mode_code == 19:
-            return "dlog_m"
-        if color_mode_code == 2:
-            return "d_log"
+        color_mode_code = get_color_mode_code(binary_data)
+    except (ValueError, IndexError):
         return "default"
-    except:
+    if color_mode_code is None:
         return "default"
+    print(f"Color mode code: {color_mode_code}; file: {file}")
+    return COLOR_MODE_BY_CODE.get(color_mode_code, "default")
+
+
+def _probe_one(file):
+    encoder = read_mp4_encoder_tag(file)
+    if encoder is None:
+        metadata = get_video_metadata(file)
+        encoder = metadata['format'].get('tags', {}).get('encoder', "")
+    if "DJI" not in encoder:
+        return None
+    color_mode = color_mode_for_file(file)
+    if color_mode is None:
+        color_mode = get_color_mode_from_data_stream(file)
+    return file, color_mode
 
 
 def get_dji_videos_with_color_mode(files) -> List[Tuple[str, str]]:
-    dji_files = []
-    for f in files:
-        metadata = get_video_metadata(f)
-        tags = metadata['format']['tags']
-        if "encoder" in tags and "DJI" in tags['encoder']:
-            color_mode = get_color_mode_from_subs(f)
-            if color_mode is None:
-                color_mode = get_color_mode_from_data_stream(f)
-            dji_files.append((f, color_mode))
-    return dji_files
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        return [result for result in executor.map(_probe_one, files) if result is not None]
 
 
 def get_filename_without_extension(file):
@@ -136,14 +196,24 @@ def get_video_files(directory):
         raise FileNotFoundError(f"Directory '{directory}' not found.")
 
     file_paths = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if (file.lower().endswith(".mp4") or file.lower().endswith(
-                    ".mov")) and video_preview_file_suffix not in file.lower():
-                if regenerate_previews:
-                    file_paths.append(os.path.join(root, file))
-                elif not os.path.exists(os.path.join(root, get_preview_filename(file))):
-                    file_paths.append(os.path.join(root, file))
+    pending_dirs = [directory]
+    while pending_dirs:
+        try:
+            with os.scandir(pending_dirs.pop()) as it:
+                entries = list(it)
+        except OSError:
+            # skip unreadable directories (e.g. System Volume Information on
+            # external drives), matching the old os.walk behaviour
+            continue
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending_dirs.append(entry.path)
+                continue
+            name = entry.name.lower()
+            if (name.endswith(".mp4") or name.endswith(".mov")) and video_preview_file_suffix not in name:
+                if regenerate_previews or get_preview_filename(entry.name) not in names:
+                    file_paths.append(entry.path)
 
     return file_paths
 
@@ -152,7 +222,64 @@ def get_preview_filename(file):
     return f"{get_filename_without_extension(file)}{video_preview_file_suffix}{output_extension}"
 
 
+def _parse_encoder_atom(chunk):
+    """Find a structurally valid (c)too atom in the chunk and return its payload.
+
+    A real (c)too atom is small and wraps exactly one 'data' atom:
+    size(4) '(c)too' size(4) 'data' type+flags(4) locale(4) payload.
+    Every candidate match is validated against that layout so stray byte
+    sequences in compressed mdat data are rejected rather than returned
+    as a garbage tag.
+    """
+    pos = 0
+    while True:
+        atom_pos = chunk.find(b'\xa9too', pos)
+        if atom_pos < 0:
+            return None
+        pos = atom_pos + 1
+        if atom_pos < 4:
+            continue
+        too_size = int.from_bytes(chunk[atom_pos - 4:atom_pos], 'big')
+        if too_size <= 24 or too_size > 1024 or atom_pos - 4 + too_size > len(chunk):
+            continue
+        if chunk[atom_pos + 8:atom_pos + 12] != b'data':
+            continue
+        data_size = int.from_bytes(chunk[atom_pos + 4:atom_pos + 8], 'big')
+        if data_size != too_size - 8:
+            continue
+        payload = chunk[atom_pos + 20:atom_pos + 4 + data_size]
+        try:
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+
+
+def read_mp4_encoder_tag(file_path):
+    """Read the encoder tag from the moov/udta/ilst atoms without spawning ffprobe.
+
+    The tag normally sits near the end of the file, so a 64 KB tail read is
+    enough; falls back to a head read for files with moov at the front.
+    Returns None if no valid tag is found, letting the caller fall back to
+    ffprobe.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            f.seek(max(0, file_size - 65536))
+            encoder = _parse_encoder_atom(f.read(65536))
+            if encoder is None:
+                f.seek(0)
+                encoder = _parse_encoder_atom(f.read(65536))
+            return encoder
+    except OSError:
+        return None
+
+
 def get_video_metadata(file_path):
+    cache_key = (os.path.abspath(file_path), os.path.getmtime(file_path))
+    if cache_key in _video_metadata_cache:
+        return _video_metadata_cache[cache_key]
     ffmpeg_command = [
         'ffprobe',
         '-v', 'quiet',
@@ -161,60 +288,56 @@ def get_video_metadata(file_path):
         '-show_format',
         '-i', file_path,
     ]
-    result = subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
-    return json.loads(result.stdout)
-
-
-def load_binary_file(file_path):
-    with open(file_path, 'rb') as f:
-        return f.read()
-
-
-def process_video_files(directory, lut_file):
+    metadata = json.loads(run_command(ffmpeg_command, capture_stdout=True))
+    _video_metadata_cache[cache_key] = metadata
+    return metadata
+
+
+def process_single_file(index, total_files, input_file, color_mode, lut_file, gpu):
+    print(Fore.GREEN + f"Processing {index}/{total_files}. {input_file}" + Style.RESET_ALL)
+    output_directory = os.path.dirname(input_file)
+    print(f"\t\tColor mode: {color_mode}")
+    output_filename = get_preview_filename(input_file)
+    output_file = os.path.join(
+        output_directory, output_filename)
+    if color_mode is not None and color_mode.lower() in convertable_color_modes:
+        intermediate_file = None
+        if keep_intermediate:
+            intermediate_file = os.path.join(
+                output_directory,
+                f"{get_filename_without_extension(output_filename)}_intermediate{output_extension}")
+        try:
+            if backend == "pynvc":
+                import pynvc_backend
+                pynvc_backend.transcode(input_file, output_file, lut_file,
+                                        final_video_bitrate, gpu)
+            elif backend == "cpu":
+                import cpu_backend
+                cpu_backend.transcode(input_file, output_file, lut_file,
+                                      final_video_bitrate)
+            else:
+                resize_and_apply_lut(input_file, output_file, lut_file, gpu, intermediate_file)
+        except:
+            pass
+    else:
+        print(f"\t\tSkipping...")
+        # resize(input_file, output_file, final_video_bitrate)
+
+
+def process_video_files(directory, lut_file, max_workers=2):
     files = get_video_files(directory)
     files = get_dji_videos_with_color_mode(files)
     total_files = len(files)
     print(f"Found {total_files} video files")
-    for i, (input_file, color_mode) in enumerate(files, start=1):
-        print(Fore.GREEN + f"Processing {i}/{total_files}. {input_file}" + Style.RESET_ALL)
-        output_directory = os.path.dirname(input_file)
-        print(f"\t\tColor mode: {color_mode}")
-        output_filename = get_preview_filename(input_file)
-        output_file = os.path.join(
-            output_directory, output_filename)
-        if color_mode is not None and color_mode.lower() in convertable_color_modes:
-            intermediate_file = os.path.join(temp_video_dir, output_filename)
-            try:
-                resize(input_file, intermediate_file, intermediate_video_bitrate)
-                apply_lut(intermediate_file, output_file, lut_file)
-            except:
-                pass
-        else:
-            print(f"\t\tSkipping...")
-            # resize(input_file, output_file, final_video_bitrate)
-
-
-def resize(input_file, output_file, bitrate):
-    print(f"\t\tResizing...")
-    ffmpeg_command = [
-        'ffmpeg',
-        '-y',
-        '-vsync', '0',
-        '-stats', '-loglevel', 'error',
-        '-hwaccel', 'cuda',
-        '-hwaccel_output_format', 'cuda',
-        '-i', input_file,
-        '-vf',
-        f"scale_cuda=1920:-1",
-        '-c:v', 'hevc_nvenc',
-        '-preset', encoding_preset,
-        '-b:v', bitrate,
-        '-maxrate', max_video_bitrate,
-        '-bufsize', video_buffer_size,
-        '-an', '-sn', '-dn',
-        output_file
-    ]
-    subprocess.run(ffmpeg_command, check=True)
+    gpu_count = count_gpus()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(process_single_file, i, total_files, input_file, color_mode,
+                            lut_file, (i - 1) % gpu_count)
+            for i, (input_file, color_mode) in enumerate(files, start=1)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 def setup_args_parser():
@@ -223,6 +346,18 @@ def setup_args_parser():
                         help="Path to LUT file.")
     parser.add_argument("-rp", "--regenerate_previews", action="store_true",
                         help="If specified, the script will regenerate all previews. Default: false")
+    parser.add_argument("-j", "--jobs", type=int, default=2,
+                        help="Number of videos to process concurrently. Default: 2")
+    parser.add_argument("-b", "--backend", choices=["ffmpeg", "pynvc", "cpu"], default="ffmpeg",
+                        help="Transcoding backend. pynvc keeps decode/grade/encode on the GPU "
+                             "via PyNvVideoCodec + cupy; cpu uses PyAV + NumPy + libx265 on "
+                             "machines without an NVIDIA GPU. Default: ffmpeg")
+    parser.add_argument("-ep", "--encode_profile", choices=sorted(NVENC_PROFILES),
+                        default="quality",
+                        help="NVENC speed/quality trade-off. Default: quality")
+    parser.add_argument("-ki", "--keep_intermediate", action="store_true",
+                        help="If specified, the resized (pre-LUT) video is kept next to the preview. "
+                             "Default: false")
     parser.add_argument("input_directory", help="Directory with input video files.")
     return parser
 
@@ -233,29 +368,15 @@ if __name__ == "__main__":
     args = parser.parse_args()
     if args.regenerate_previews:
         regenerate_previews = True
+    if args.keep_intermediate:
+        keep_intermediate = True
+    encode_profile = args.encode_profile
+    backend = args.backend
+    check_backend_dependencies(backend)
 
     input_directory = args.input_directory
-    lut_file = copy_file_to_temp_dir(args.lut_file)
-
-    # temp video encode dir
-    temp_video_dir = os.path.join(input_directory, temp_dir)
-    if os.path.exists(temp_video_dir):
-        try:
-            shutil.rmtree(temp_video_dir)
-        except OSError as e:
-            print(f"Error deleting temporary video directory: {e}")
-            sys.exit(1)
-    os.mkdir(temp_video_dir)
-
-    process_video_files(input_directory, lut_file)
+    lut_file = Path(args.lut_file).resolve().as_posix()
 
-    try:
-        shutil.rmtree(os.path.dirname(lut_file))
-    except OSError as e:
-        print(f"Error deleting temporary directory: {e}")
-    try:
-        shutil.rmtree(temp_video_dir)
-    except OSError as e:
-        print(f"Error deleting temporary video encode directory: {e}")
+    process_video_files(input_directory, lut_file, args.jobs)
 
     print("Done!")
@@ -0,0 +1,118 @@
+"""
+PyNvVideoCodec-based resize+LUT backend for DJI preview generation.
+
+Keeps NVDEC/NVENC busy from a single process instead of paying ffmpeg
+startup per file: frames are decoded straight to device memory, resized
+and graded with CuPy, and handed to NVENC without leaving the GPU. ffmpeg
+is only invoked once per file at the end to remux the audio stream.
+
+Requires the optional PyNvVideoCodec and cupy packages.
+"""
+
+import os
+import tempfile
+
+from dji_common import load_cube_lut, parse_bitrate, run_command
+
+
+def _nv12_to_rgb(cp, nv12, height, width):
+    y = nv12[:height, :width].astype(cp.float32)
+    uv = nv12[height:height + height // 2, :width].reshape(height // 2, width // 2, 2)
+    u = uv[..., 0].astype(cp.float32).repeat(2, axis=0).repeat(2, axis=1)
+    v = uv[..., 1].astype(cp.float32).repeat(2, axis=0).repeat(2, axis=1)
+    # BT.709 limited range: luma spans 219 steps, chroma 224
+    y = (y - 16.0) * (255.0 / 219.0)
+    u = (u - 128.0) * (255.0 / 224.0)
+    v = (v - 128.0) * (255.0 / 224.0)
+    r = y + 1.5748 * v
+    g = y - 0.1873 * u - 0.4681 * v
+    b = y + 1.8556 * u
+    return cp.clip(cp.stack([r, g, b], axis=-1) / 255.0, 0.0, 1.0)
+
+
+def _rgb_to_nv12(cp, rgb):
+    height, width = rgb.shape[:2]
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    u = (b - y) / 1.8556
+    v = (r - y) / 1.5748
+    y = y * 219.0 + 16.0
+    u = (u[0::2, 0::2] + u[1::2, 0::2] + u[0::2, 1::2] + u[1::2, 1::2]) * (224.0 / 4.0) + 128.0
+    v = (v[0::2, 0::2] + v[1::2, 0::2] + v[0::2, 1::2] + v[1::2, 1::2]) * (224.0 / 4.0) + 128.0
+    nv12 = cp.empty((height * 3 // 2, width), dtype=cp.uint8)
+    nv12[:height] = cp.clip(cp.rint(y), 0, 255).astype(cp.uint8)
+    uv = cp.stack([u, v], axis=-1).reshape(height // 2, width)
+    nv12[height:] = cp.clip(cp.rint(uv), 0, 255).astype(cp.uint8)
+    return nv12
+
+
+def _apply_lut(cp, map_coordinates, rgb, lut):
+    size = lut.shape[0]
+    # lut is indexed [b, g, r], so coordinates go blue-first
+    coords = cp.stack([rgb[..., 2], rgb[..., 1], rgb[..., 0]], axis=0) * (size - 1)
+    coords = coords.reshape(3, -1)
+    out = cp.empty_like(rgb)
+    for channel in range(3):
+        out[..., channel] = map_coordinates(
+            lut[..., channel], coords, order=1).reshape(rgb.shape[:2])
+    return out
+
+
+def _frame_rate(input_file):
+    stdout = run_command(
+        ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0',
+         '-show_entries', 'stream=r_frame_rate', '-of', 'csv=p=0', input_file],
+        capture_stdout=True)
+    num, _, den = stdout.decode().strip().partition('/')
+    return f"{num}/{den}" if den else num
+
+
+def transcode(input_file, output_file, lut_file, bitrate, gpu=0, target_width=1920):
+    """Decode, resize, grade, and re-encode entirely on the GPU, then remux audio."""
+    import cupy as cp
+    import PyNvVideoCodec as nvc
+    from cupyx.scipy.ndimage import map_coordinates, zoom
+
+    lut = cp.asarray(load_cube_lut(lut_file))
+    demuxer = nvc.CreateDemuxer(filename=input_file)
+    decoder = nvc.CreateDecoder(gpuid=gpu, codec=demuxer.GetNvCodecId(),
+                                cudacontext=0, cudastream=0, usedevicememory=True)
+
+    encoder = None
+    bitstream_file = tempfile.NamedTemporaryFile(
+        suffix=".hevc", dir=os.path.dirname(output_file) or None, delete=False)
+    try:
+        with bitstream_file:
+            for packet in demuxer:
+                for decoded_frame in decoder.Decode(packet):
+                    height, width = decoder.GetHeight(), decoder.GetWidth()
+                    nv12 = cp.asarray(decoded_frame.cuda()).reshape(height * 3 // 2, -1)
+                    rgb = _nv12_to_rgb(cp, nv12, height, width)
+                    scale = target_width / width
+                    out_height = int(round(height * scale / 2)) * 2
+                    rgb = zoom(rgb, (out_height / height, target_width / width, 1), order=1)
+                    rgb = _apply_lut(cp, map_coordinates, rgb, lut)
+                    nv12 = _rgb_to_nv12(cp, rgb)
+                    if encoder is None:
+                        encoder = nvc.CreateEncoder(
+                            target_width, out_height, "NV12", False,
+                            codec="hevc", preset="P7",
+                            bitrate=parse_bitrate(bitrate))
+                    bitstream_file.write(bytearray(encoder.Encode(nv12)))
+            if encoder is not None:
+                bitstream_file.write(bytearray(encoder.EndEncode()))
+
+        # remux the raw bitstream with the original audio in one copy pass
+        run_command(
+            ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error',
+             '-r', _frame_rate(input_file),
+             '-i', bitstream_file.name,
+             '-i', input_file,
+             '-map', '0:v', '-map', '1:a?',
+             '-c', 'copy',
+             output_file])
+    finally:
+        try:
+            os.unlink(bitstream_file.name)
+        except OSError:
+            pass